@@ -6,70 +6,41 @@
 # The AGPL is a copyleft license that ensures the freedom to use, modify, and distribute the library's code, even in the case of web-based services.
 # By using directdb, you agree to comply with the terms and conditions of the AGPL.
 
-import datetime
+import logging
 
-class DatabaseTableException(Exception):
-	"""Class for exceptions when table creation fails.
-	
-	Parameters
-	----------
-	message: str
-		The error message.
-	"""
-
-	def __init__(self, message):
-		print(f"- ERROR {datetime.datetime.now()} | {self.__class__.__name__} | {message} \n")
-		super().__init__(message)
+_log = logging.getLogger("directdb")
 
-class DatabaseInsertionException(Exception):
-	"""Class for exceptions when insertion into database fails.
+class DatabaseException(Exception):
+	"""Base class for all the database exceptions, logging the error when raised.
 	
 	Parameters
 	----------
 	message: str
-		The error message.
+		The error message, other objects such as the original exception are converted to a string.
 	"""
 
 	def __init__(self, message):
-		print(f"- ERROR {datetime.datetime.now()} | {self.__class__.__name__} | {message} \n")
-		super().__init__(message)
+		self.message = str(message)
+		_log.error("%s | %s", type(self).__name__, self.message)
+		super().__init__(self.message)
 
-class DatabaseFetchException(Exception):
-	"""Class for exceptions when table fetching fails.
-	
-	Parameters
-	----------
-	message: str
-		The error message.
-	"""
+	def __str__(self):
+		return self.message
 
-	def __init__(self, message):
-		print(f"- ERROR {datetime.datetime.now()} | {self.__class__.__name__} | {message} \n")
-		super().__init__(message)
+class DatabaseTableException(DatabaseException):
+	"""Class for exceptions when table creation fails."""
 
-class DatabaseUpdateException(Exception):
-	"""Class for exceptions when table fetching fails.
-	
-	Parameters
-	----------
-	message: str
-		The error message.
-	"""
+class DatabaseInsertionException(DatabaseException):
+	"""Class for exceptions when insertion into database fails."""
 
-	def __init__(self, message):
-		print(f"- ERROR {datetime.datetime.now()} | {self.__class__.__name__} | {message} \n")
-		super().__init__(message)
+class DatabaseFetchException(DatabaseException):
+	"""Class for exceptions when table fetching fails."""
 
-class DatabaseDeleteException(Exception):
-	"""Class for exceptions when table fetching fails.
-	
-	Parameters
-	----------
-	message: str
-		The error message.
-	"""
+class DatabaseUpdateException(DatabaseException):
+	"""Class for exceptions when updating data fails."""
 
-	def __init__(self, message):
-		self.message = message
-		print(f"- ERROR {datetime.datetime.now()} | {self.__class__.__name__} | {message} \n")
-		super().__init__(message)
\ No newline at end of file
+class DatabaseDeleteException(DatabaseException):
+	"""Class for exceptions when deleting data fails."""
+
+class DatabaseTransactionException(DatabaseException):
+	"""Class for exceptions when starting or committing a transaction fails."""
@@ -7,9 +7,85 @@
 # By using directdb, you agree to comply with the terms and conditions of the AGPL.
 
 import asyncio
+import collections
+import contextvars
+import functools
+import inspect
+import itertools
+import logging
+import weakref
+from contextlib import asynccontextmanager
+
 import asyncpg
 
 from .exceptions import *
+from .utils import quote_identifier, sort_order
+
+_SELECT_ALL = 'SELECT * FROM {}'.format
+
+_log = logging.getLogger("directdb")
+
+#The most idle connections a keepalive round holds at once, the rest stay free for queries.
+_KEEPALIVE_PINGS = 2
+
+def _qid(name:str) -> str:
+	#Unquoted names are lowercased by PostgreSQL, fold them the same way so quoting doesn't change which table is used.
+	return quote_identifier(name, True)
+
+def _folded_name(name:str, max_parts:int) -> list:
+	#asyncpg quotes the names of COPY targets itself, so only validate and lowercase them the way _qid does.
+	_qid(name)
+	parts = name.lower().split('.')
+	if len(parts) > max_parts:
+		raise ValueError("Invalid identifier: {!r}".format(name))
+	return parts
+
+#Precomputed $N placeholders, queries with more parameters than this fall back to formatting them.
+_PARAMS = tuple('${}'.format(i) for i in range(1, 129))
+
+def _param(index:int) -> str:
+	return _PARAMS[index] if index < len(_PARAMS) else '${}'.format(index + 1)
+
+def _assignments(columns:tuple, separator:str, offset:int = 0) -> str:
+	return separator.join(f'{_qid(column)} = {_param(i + offset)}' for i, column in enumerate(columns))
+
+#The generated SQL only depends on the table and column names, so it is built once per signature.
+#Identical query text also lets asyncpg reuse its prepared statements across calls.
+@functools.lru_cache(maxsize=1024)
+def _build_insert_sql(table:str, columns:tuple) -> str:
+	column_names = ', '.join(_qid(column) for column in columns)
+	values = ', '.join(_param(i) for i in range(len(columns)))
+	return 'INSERT INTO {} ({}) VALUES ({})'.format(_qid(table), column_names, values)
+
+@functools.lru_cache(maxsize=1024)
+def _build_select_sql(table:str, filter_columns:tuple = (), sort_by:str = None, sort:str = None) -> str:
+	query = _SELECT_ALL(_qid(table))
+	if filter_columns:
+		query += ' WHERE {}'.format(_assignments(filter_columns, ' AND '))
+	if sort_by and sort:
+		query += ' ORDER BY {} {}'.format(_qid(sort_by), sort_order(sort))
+	return query
+
+@functools.lru_cache(maxsize=1024)
+def _build_update_sql(table:str, columns:tuple, filter_columns:tuple) -> str:
+	#Since $1, $2 etc are used in update data, we need to continue from there for data_filter data to avoid errors.
+	set_columns = _assignments(columns, ', ')
+	data_filters = _assignments(filter_columns, ' AND ', len(columns))
+	return 'UPDATE {} SET {} WHERE {}'.format(_qid(table), set_columns, data_filters)
+
+@functools.lru_cache(maxsize=1024)
+def _build_delete_sql(table:str, filter_columns:tuple) -> str:
+	return 'DELETE FROM {} WHERE {}'.format(_qid(table), _assignments(filter_columns, ' AND '))
+
+
+#The reset hook of create_pool was added in asyncpg 0.30.0.
+_POOL_SUPPORTS_RESET = 'reset' in inspect.signature(asyncpg.create_pool).parameters
+
+async def _release_without_reset(con) -> None:
+	#asyncpg still rolls back a transaction left open before calling this, only the
+	#RESET ALL/UNLISTEN/advisory unlock round trip is skipped.
+	pass
+
 
 class Postgresql:
 
@@ -27,16 +103,61 @@ class Postgresql:
 		The database name.
 	port: int
 		The port of the database.
+	min_size: int [Optional]
+		The number of connections the pool is initialized with. Defaults to 10.
+	max_size: int [Optional]
+		The maximum number of connections in the pool. Defaults to 10.
+	statement_cache_size: int [Optional]
+		The size of the prepared statement cache of each connection. Defaults to 1024.
+	max_inactive_connection_lifetime: float [Optional]
+		The seconds after which idle connections are closed, 0 keeps them open. Defaults to 0.
+	max_queries: int [Optional]
+		The number of queries after which a connection is replaced. Defaults to 50000.
+	reset_on_release: bool [Optional]
+		Whether to fully reset the session state (settings, listeners, advisory locks) when a connection
+		is released back to the pool. Defaults to False, which only rolls back open transactions.
+		Skipping the reset needs asyncpg 0.30.0 or newer, older versions always reset.
+	server_settings: dict [Optional]
+		Server settings applied to every connection, e.g. {'jit': 'off'} for short queries.
+	prepared: bool [Optional]
+		Whether `insert`, `fetch`, `update` and `delete` should run through explicitly prepared statements.
+		asyncpg invalidates prepared statements whenever a connection is released back to the pool, so they
+		are only reused while the connection stays checked out, as inside `pipeline()`. Outside of a pipeline
+		each call pays an extra round trip, asyncpg's own statement cache already covers that case.
+		Defaults to False.
+	keepalive_interval: float [Optional]
+		The seconds between background `SELECT 1` pings of a couple of idle connections, keeping them warm
+		and replacing the ones reaped by the server. None disables the pings. Defaults to 60.
 
 	"""
 	pool = None
+	_keepalive = None
 
-	def __init__(self, host, user, password, database, port):
+	def __init__(
+		self, host, user, password, database, port, *,
+		min_size:int = 10, max_size:int = 10, statement_cache_size:int = 1024,
+		max_inactive_connection_lifetime:float = 0, max_queries:int = 50000,
+		reset_on_release:bool = False, server_settings:dict = None, prepared:bool = False,
+		keepalive_interval:float = 60
+	):
 		self.host = host
 		self.user = user
 		self.password = password
 		self.database = database
 		self.port = port
+		self.min_size = min_size
+		self.max_size = max_size
+		self.statement_cache_size = statement_cache_size
+		self.max_inactive_connection_lifetime = max_inactive_connection_lifetime
+		self.max_queries = max_queries
+		self.reset_on_release = reset_on_release
+		self.server_settings = server_settings
+		self.prepared = prepared
+		self.keepalive_interval = keepalive_interval
+		#Prepared statements belong to a single checkout of a connection, so keep one LRU of them per pooled connection.
+		self._stmt_cache = weakref.WeakKeyDictionary()
+		#The task owning the open pipeline() context and its connection, if any.
+		self._pipeline = contextvars.ContextVar('directdb_pipeline', default=None)
 
 	async def connect(self) -> asyncpg.Pool:
 		""" Connects to the database. 
@@ -47,12 +168,131 @@ class Postgresql:
 			The custom database handler class.
 
 		"""
+		pool_kwargs = {
+			'min_size': self.min_size,
+			'max_size': self.max_size,
+			'statement_cache_size': self.statement_cache_size,
+			'max_inactive_connection_lifetime': self.max_inactive_connection_lifetime,
+			'max_queries': self.max_queries,
+		}
+		if not self.reset_on_release and _POOL_SUPPORTS_RESET:
+			pool_kwargs['reset'] = _release_without_reset
+		if self.server_settings:
+			pool_kwargs['server_settings'] = self.server_settings
+
 		self.pool = await asyncpg.create_pool(
-			host=self.host, user=self.user, password=self.password, database=self.database, port=self.port
+			host=self.host, user=self.user, password=self.password, database=self.database, port=self.port,
+			**pool_kwargs
 		)
+		if self._keepalive:
+			self._keepalive.cancel()
+			self._keepalive = None
+		if self.keepalive_interval:
+			self._keepalive = asyncio.create_task(self._keepalive_loop())
 		return self.pool
+
+	async def _ping(self) -> None:
+		async with self.pool.acquire(timeout=1) as con:
+			await con.execute('SELECT 1')
+
+	async def _keepalive_loop(self) -> None:
+		while True:
+			await asyncio.sleep(self.keepalive_interval)
+			#A connection dropped by the server fails its ping and is replaced by the pool on the next acquire.
+			pings = min(self.pool.get_idle_size(), _KEEPALIVE_PINGS)
+			results = await asyncio.gather(*[self._ping() for _ in range(pings)], return_exceptions=True)
+			for result in results:
+				if isinstance(result, Exception):
+					_log.warning("Keepalive ping failed | %s", result)
+
+	async def close(self) -> None:
+		""" Stops the keepalive pings and closes all the connections of the pool. """
+		if self._keepalive:
+			self._keepalive.cancel()
+			self._keepalive = None
+		if self.pool:
+			await self.pool.close()
 	
 
+	async def _prepared(self, con, query:str) -> asyncpg.prepared_stmt.PreparedStatement:
+		#The pool hands out a proxy per acquire, the cache is keyed by the connection behind it. asyncpg
+		#bumps the connection's release counter on every release, which invalidates all of its statements.
+		release_ctr = con._con._pool_release_ctr
+		cached = self._stmt_cache.get(con._con)
+		if cached is None or cached[0] != release_ctr:
+			cached = self._stmt_cache[con._con] = (release_ctr, collections.OrderedDict())
+		statements = cached[1]
+		try:
+			statements.move_to_end(query)
+			return statements[query]
+		except KeyError:
+			statement = statements[query] = await con.prepare(query)
+			if len(statements) > self.statement_cache_size:
+				statements.popitem(last=False)
+			return statement
+
+	async def _run_on(self, con, method:str, query:str, *args):
+		if not self.prepared:
+			return await getattr(con, method)(query, *args)
+
+		statement = await self._prepared(con, query)
+		try:
+			if method == 'execute':
+				#Prepared statements have no execute(), fetching an empty result is equivalent.
+				return await statement.fetch(*args)
+			return await getattr(statement, method)(*args)
+		except asyncpg.exceptions.InvalidCachedStatementError:
+			#The schema changed underneath the statement, prepare it again next time.
+			self._stmt_cache[con._con][1].pop(query, None)
+			raise
+
+	async def _run(self, method:str, query:str, *args):
+		con = self._pipeline_connection()
+		if con is not None:
+			return await self._run_on(con, method, query, *args)
+		if not self.prepared:
+			return await getattr(self.pool, method)(query, *args)
+
+		async with self.pool.acquire() as con:
+			return await self._run_on(con, method, query, *args)
+
+	def _pipeline_connection(self):
+		#Tasks spawned inside a pipeline inherit the context variable but must not share its connection,
+		#which can only run one query at a time, so only the owning task gets it.
+		pipeline = self._pipeline.get()
+		if pipeline is not None and pipeline[0] is asyncio.current_task():
+			return pipeline[1]
+		return None
+
+	@asynccontextmanager
+	async def pipeline(self):
+		""" Runs the operations made inside the context on a single connection and transaction.
+
+		`insert`, `insert_many`, `copy_records`, `fetch`, `fetch_iter` and `update`/`delete` calls awaited
+		directly by the task which opened the context reuse one pooled connection instead of acquiring and
+		releasing one per call, and everything is committed once when the context exits, or rolled back if
+		an exception is raised. Calls made from other tasks, including ones spawned inside the context
+		such as with `asyncio.gather`, run on their own connections outside of the pipeline's transaction.
+
+		Yields
+		------
+		Postgresql
+			The database handler itself.
+
+		"""
+		if self._pipeline_connection() is not None:
+			#Nested contexts join the already running pipeline.
+			yield self
+			return
+
+		async with self.pool.acquire() as con:
+			async with con.transaction():
+				token = self._pipeline.set((asyncio.current_task(), con))
+				try:
+					yield self
+				finally:
+					self._pipeline.reset(token)
+
 	async def create_table(self, tables:list) -> None:
 		""" Creates table(s) in the database.
 		
@@ -61,16 +301,22 @@ class Postgresql:
 		tables: list
 			A list in format of [{'table_name': {'column_name:'datatype'}}]
 		"""
-		for table in tables:
-			for name, columns in table.items():
-				try:
-					columns = ', '.join(['{} {}'.format(column, datatype) for column, datatype in columns.items()])
-					query = 'CREATE TABLE IF NOT EXISTS {} ({})'.format(name, columns)
-					await asyncio.sleep(0.2)
-					await self.pool.execute(query)
+		try:
+			queries = []
+			for table in tables:
+				for name, columns in table.items():
+					columns = ', '.join(['{} {}'.format(_qid(column), datatype) for column, datatype in columns.items()])
+					queries.append('CREATE TABLE IF NOT EXISTS {} ({})'.format(_qid(name), columns))
+			if not queries:
+				return
 
-				except Exception as e:
-					raise DatabaseTableException(e)
+			#DDL is transactional in PostgreSQL, so all the tables are created in a single round trip.
+			async with self.pool.acquire() as con:
+				async with con.transaction():
+					await con.execute('; '.join(queries))
+
+		except Exception as e:
+			raise DatabaseTableException(str(e)) from e
 
 	async def drop_table(self, table:str) -> None:
 		""" Drops a table from the database.
@@ -82,10 +328,10 @@ class Postgresql:
 
 		"""
 		try:
-			query = 'DROP TABLE IF EXISTS {}'.format(table)
+			query = 'DROP TABLE IF EXISTS {}'.format(_qid(table))
 			await self.pool.execute(query)
 		except Exception as e:
-			raise DatabaseTableException(e)
+			raise DatabaseTableException(str(e)) from e
 
 	async def insert(self, table: str, **data) -> None:
 
@@ -98,15 +344,127 @@ class Postgresql:
 		data: **kwargs dict
 			The data to insert into the table in format column_name = data.
 
+		"""
+		await self.insert_positional(table, tuple(data), tuple(data.values()))
+
+	async def insert_positional(self, table: str, columns: tuple, values: tuple) -> None:
+		""" Inserts a row whose values are already ordered like the given columns.
+		
+		Parameters
+		----------
+		table: str
+			The table to insert data into.
+		columns: tuple
+			The column names.
+		values: tuple
+			The values to insert, in the same order as `columns`.
+
 		"""
 		try:
-			columns = ', '.join(data.keys())
-			values = ', '.join(['${}'.format(i + 1) for i in range(len(data))])
-			query = 'INSERT INTO {} ({}) VALUES ({})'.format(table, columns, values)
-			await self.pool.execute(query, *data.values())
+			query = _build_insert_sql(table, tuple(columns))
+			await self._run('execute', query, *values)
 		except Exception as e:
-			raise DatabaseInsertionException(e)
+			raise DatabaseInsertionException(str(e)) from e
+
+	def specialize(self, schema:dict) -> None:
+		""" Generates an `insert_<table>` method per table with its query built ahead of time.
+
+		The generated methods take the values positionally, e.g. `await db.insert_users(1, 'name')`
+		for a schema of {'users': ['id', 'name']}, skipping all the query building of `insert`.
+
+		Parameters
+		----------
+		schema: dict
+			The tables and their columns in format {'table_name': ['column_name', ...]}
+
+		"""
+		for table, columns in schema.items():
+			name = 'insert_{}'.format(table.replace('.', '_'))
+			if hasattr(type(self), name):
+				raise ValueError("Cannot specialize table {!r}, {} is already a method".format(table, name))
+			query = _build_insert_sql(table, tuple(columns))
+
+			async def insert(*values, _query=query):
+				try:
+					await self._run('execute', _query, *values)
+				except Exception as e:
+					raise DatabaseInsertionException(str(e)) from e
+
+			setattr(self, name, insert)
+
+	async def insert_many(self, table: str, columns: list, rows, *, batch_size: int = 10_000) -> None:
+		""" Inserts multiple rows into the database using a single prepared statement.
+
+		All the rows are inserted in one transaction, so if one of them fails none of them are inserted.
 		
+		Parameters
+		----------
+		table: str
+			The table to insert data into.
+		columns: list
+			The column names, in the same order as the values in each row.
+		rows: iterable
+			An iterable of tuples, each holding the values of one row.
+		batch_size: int [Optional]
+			The number of rows sent to the server per `executemany` call. Defaults to 10000.
+
+		"""
+		try:
+			query = _build_insert_sql(table, tuple(columns))
+			con = self._pipeline_connection()
+			if con is not None:
+				await self._insert_batches(con, query, rows, batch_size)
+				return
+
+			#Every batch runs in the same transaction so a failing row doesn't leave the earlier batches applied.
+			async with self.pool.acquire() as con:
+				async with con.transaction():
+					await self._insert_batches(con, query, rows, batch_size)
+		except Exception as e:
+			raise DatabaseInsertionException(str(e)) from e
+
+	async def _insert_batches(self, con, query:str, rows, batch_size:int) -> None:
+		rows = iter(rows)
+		while True:
+			batch = list(itertools.islice(rows, batch_size))
+			if not batch:
+				break
+			await self._run_on(con, 'executemany', query, batch)
+
+	async def copy_records(self, table: str, columns: list, records) -> None:
+		""" Bulk loads rows into the database using the COPY protocol.
+
+		This is considerably faster than `insert_many` for large loads, however COPY
+		does not support `ON CONFLICT`, so use `insert_many` where conflicts must be handled.
+		Inside `pipeline()` the records are copied within the pipeline's transaction.
+
+		Parameters
+		----------
+		table: str
+			The table to copy the records into.
+		columns: list
+			The column names, in the same order as the values in each record.
+		records: iterable or async iterable
+			The records to copy, each one a tuple of values.
+
+		"""
+		try:
+			parts = _folded_name(table, 2)
+			copy_kwargs = {
+				'records': records,
+				'columns': [_folded_name(column, 1)[0] for column in columns],
+				'schema_name': parts[0] if len(parts) == 2 else None,
+			}
+
+			con = self._pipeline_connection()
+			if con is not None:
+				await con.copy_records_to_table(parts[-1], **copy_kwargs)
+				return
+			async with self.pool.acquire() as con:
+				await con.copy_records_to_table(parts[-1], **copy_kwargs)
+		except Exception as e:
+			raise DatabaseInsertionException(str(e)) from e
+
 
 	async def fetch(self, table:str, *, data_filter:dict = None, **sorting) -> list:
 		""" Fetches data from the database.
@@ -130,26 +488,82 @@ class Postgresql:
 		"""
 		try:
 			if not data_filter:
-				query = 'SELECT * FROM {}'.format(table)
-				if sorting:
-					sort_by = sorting.get('sort_by', None)
-					sort = sorting.get('sort', None)
-					if sort_by and sort:
-						query += ' ORDER BY {} {}'.format(sort_by, sort)
-				return await self.pool.fetch(query)
+				if not sorting:
+					#Plain "SELECT *" needs no filter or sort handling at all.
+					return await self._run('fetch', _SELECT_ALL(_qid(table)))
+				query = _build_select_sql(table, (), sorting.get('sort_by'), sorting.get('sort'))
+				return await self._run('fetch', query)
 			else:
-				data_filters = ' AND '.join(['{} = ${}'.format(column, i + 1) for i, column in enumerate(data_filter)])
-				query = 'SELECT * FROM {} WHERE {}'.format(table, data_filters)
-				if sorting:
-					sort_by = sorting.get('sort_by')
-					sort = sorting.get('sort')
-					if sort_by and sort:
-						query += ' ORDER BY {} {}'.format(sort_by, sort)
-				return await self.pool.fetch(query, *data_filter.values())
+				filter_columns = tuple(data_filter)
+				query = _build_select_sql(table, filter_columns, sorting.get('sort_by'), sorting.get('sort'))
+				return await self._run('fetch', query, *[data_filter[column] for column in filter_columns])
 
 		except Exception as e:
-			raise DatabaseFetchException(e)
-		
+			raise DatabaseFetchException(str(e)) from e
+
+	async def fetch_many(self, specs:list) -> list:
+		""" Runs several independent fetches concurrently on separate pool connections.
+
+		Parameters
+		----------
+		specs: list
+			A list of `fetch` arguments in format [{'table':'table name', 'data_filter':{...}, 'sort_by':..., 'sort':...}]
+
+		Returns
+		-------
+		list
+			The results of each fetch, in the same order as `specs`.
+
+		"""
+		if self._pipeline_connection() is not None:
+			#Gathered fetches would run as separate tasks outside of the pipeline, keep them on its connection instead.
+			return [await self.fetch(**spec) for spec in specs]
+		return list(await asyncio.gather(*[self.fetch(**spec) for spec in specs]))
+
+	async def fetch_iter(self, table:str, *, data_filter:dict = None, prefetch:int = 1000, **sorting):
+		""" Fetches data from the database using a server side cursor, yielding the rows as they arrive.
+
+		Unlike `fetch`, only `prefetch` rows are held in memory at a time.
+
+		Parameters
+		----------
+		table: str
+			The table to fetch data from.
+		data_filter: dict [Optional]
+			The data_filter to use in format {'column name':data}.
+		prefetch: int [Optional]
+			The number of rows fetched from the server per round trip. Defaults to 1000.
+		sort_by : str [Optional]
+			The column to sort the data by.
+		sort : str [Optional]
+			The order to sort the data by. Can be either 'ASC' or 'DESC'.
+
+		Yields
+		------
+		asyncpg.Record
+			The rows fetched from the database.
+
+		"""
+		try:
+			filter_columns = tuple(data_filter) if data_filter else ()
+			query = _build_select_sql(table, filter_columns, sorting.get('sort_by'), sorting.get('sort'))
+			args = [data_filter[column] for column in filter_columns]
+
+			con = self._pipeline_connection()
+			if con is not None:
+				#The pipeline already holds a transaction, which is all a cursor needs.
+				async for record in con.cursor(query, *args, prefetch=prefetch):
+					yield record
+				return
+
+			async with self.pool.acquire() as con:
+				async with con.transaction():
+					async for record in con.cursor(query, *args, prefetch=prefetch):
+						yield record
+
+		except Exception as e:
+			raise DatabaseFetchException(str(e)) from e
+
 	async def update(self, table:str,data_filter:dict,  **data ) -> None:
 		""" Updates data in the database.
 		
@@ -164,13 +578,12 @@ class Postgresql:
 
 		"""
 		try:
-			#Since $1, $2 etc are used in update data, we need to continue from there for data_filter data to avoid errors.
-			columns = ', '.join(['{} = ${}'.format(column, i + 1) for i, column in enumerate(data)])
-			data_filters = ' AND '.join(['{} = ${}'.format(column, i + len(data) + 1) for i, column in enumerate(data_filter)])
-			query = 'UPDATE {} SET {} WHERE {}'.format(table, columns, data_filters)
-			await self.pool.execute(query, *data.values(), *data_filter.values())
+			columns = tuple(data)
+			filter_columns = tuple(data_filter)
+			query = _build_update_sql(table, columns, filter_columns)
+			await self._run('execute', query, *[data[column] for column in columns], *[data_filter[column] for column in filter_columns])
 		except Exception as e:
-			raise DatabaseUpdateException(e)
+			raise DatabaseUpdateException(str(e)) from e
 		
 	async def delete(self, table:str, **data_filter) -> None:
 		""" Deletes data from the database.
@@ -184,8 +597,8 @@ class Postgresql:
 
 		"""
 		try:
-			data_filters = ' AND '.join(['{} = ${}'.format(column, i + 1) for i, column in enumerate(data_filter)])
-			query = 'DELETE FROM {} WHERE {}'.format(table, data_filters)
-			await self.pool.execute(query, *data_filter.values())
+			filter_columns = tuple(data_filter)
+			query = _build_delete_sql(table, filter_columns)
+			await self._run('execute', query, *[data_filter[column] for column in filter_columns])
 		except Exception as e:
-			raise DatabaseDeleteException(e)
\ No newline at end of file
+			raise DatabaseDeleteException(str(e)) from e
\ No newline at end of file
@@ -6,24 +6,84 @@
 # The AGPL is a copyleft license that ensures the freedom to use, modify, and distribute the library's code, even in the case of web-based services.
 # By using directdb, you agree to comply with the terms and conditions of the AGPL.
 
+import asyncio
+import contextvars
+import functools
+import itertools
+from contextlib import asynccontextmanager
 
 import aiosqlite
 
 from .exceptions import *
+from .utils import quote_identifier as _qid, sort_order
+
+def _conditions(columns:tuple, separator:str) -> str:
+	return separator.join(f"{_qid(column)} = ?" for column in columns)
+
+#The generated SQL only depends on the table and column names, so it is built once per signature.
+@functools.lru_cache(maxsize=1024)
+def _build_insert_sql(table:str, columns:tuple) -> str:
+	column_names = ",".join(_qid(column) for column in columns)
+	#Question marks for the values
+	values = ",".join("?" * len(columns))
+	return f"INSERT INTO {_qid(table)} ({column_names}) VALUES ({values})"
+
+@functools.lru_cache(maxsize=1024)
+def _build_select_sql(table:str, filter_columns:tuple = (), sort_by:str = None, sort:str = None) -> str:
+	query = f"SELECT * FROM {_qid(table)}"
+	if filter_columns:
+		query += f" WHERE {_conditions(filter_columns, ' AND ')}"
+	if sort_by and sort:
+		query += f" ORDER BY {_qid(sort_by)} {sort_order(sort)}"
+	return query
+
+@functools.lru_cache(maxsize=1024)
+def _build_update_sql(table:str, columns:tuple, filter_columns:tuple) -> str:
+	return f"UPDATE {_qid(table)} SET {_conditions(columns, ', ')} WHERE {_conditions(filter_columns, ' AND ')}"
+
+@functools.lru_cache(maxsize=1024)
+def _build_delete_sql(table:str, filter_columns:tuple) -> str:
+	return f"DELETE FROM {_qid(table)} WHERE {_conditions(filter_columns, ' AND ')}"
+
+def _fail_writes(items, error:Exception) -> None:
+	for _, _, future in items:
+		#A caller that was cancelled while waiting already has its future done.
+		if not future.done():
+			future.set_exception(error)
+
+def _take_queued(queue:asyncio.Queue) -> list:
+	items = []
+	while not queue.empty():
+		item = queue.get_nowait()
+		if item is not None:
+			items.append(item)
+	return items
 
 
 class SQLite:
 	
-	def __init__(self, database_file:str):
+	def __init__(self, database_file:str, *, wal:bool = True):
 		"""A class that handles all sqlite database operations efficiently.
 
 		Parameters
 		----------
 		database_file : str
 			The name of the database file.
+		wal : bool [Optional]
+			Whether to switch the database to WAL journaling with `synchronous=NORMAL` on connect,
+			which avoids an fsync on every commit. Defaults to True.
 		"""
 		self.database = database_file
+		self.wal = wal
 		self.conn = None
+		#The task running the open transaction() context, only it joins the transaction.
+		self._transaction_task = contextvars.ContextVar('directdb_sqlite_transaction_task', default=None)
+		#Keeps the writer's batches and transaction() contexts from interleaving on the connection.
+		self._write_lock = asyncio.Lock()
+		self._queue = None
+		self._writer = None
+		#The columns covered by the full text index of each table, filled in on first use.
+		self._fts_columns = {}
 
 	async def connect(self):
 		"""Connects to the database.
@@ -34,7 +94,172 @@ class SQLite:
 			The connection object of the database.
 		"""
 		self.conn = await aiosqlite.connect(self.database)
+		if self.wal:
+			await self.conn.execute("PRAGMA journal_mode=WAL")
+			await self.conn.execute("PRAGMA synchronous=NORMAL")
 		return self.conn
+
+	@asynccontextmanager
+	async def transaction(self):
+		"""Groups the operations made inside the context into a single transaction.
+
+		The data is committed once when the context exits, or rolled back if an exception is raised.
+		Other tasks wait for the transaction to finish before writing, so operations inside the
+		context must be awaited by the task which opened it rather than by tasks it spawns.
+		"""
+		if self._owns_transaction():
+			#Nested contexts join the already running transaction.
+			yield self
+			return
+
+		async with self._write_lock:
+			token = self._transaction_task.set(asyncio.current_task())
+			try:
+				try:
+					#A statement that failed outside of this class may have left sqlite3's implicit transaction open.
+					if self.conn.in_transaction:
+						await self.conn.rollback()
+					await self.conn.execute("BEGIN")
+				except Exception as e:
+					raise DatabaseTransactionException(str(e)) from e
+
+				try:
+					yield self
+				except BaseException:
+					await self.conn.rollback()
+					raise
+
+				try:
+					await self.conn.commit()
+				except Exception as e:
+					await self.conn.rollback()
+					raise DatabaseTransactionException(str(e)) from e
+			finally:
+				self._transaction_task.reset(token)
+
+	def _owns_transaction(self) -> bool:
+		task = self._transaction_task.get()
+		return task is not None and task is asyncio.current_task()
+
+	@asynccontextmanager
+	async def _writing(self):
+		#Runs writes under the write lock and commits them, or rolls them back on failure since sqlite3
+		#leaves its implicit transaction open when a statement fails. Inside transaction() the commit
+		#happens once when the context exits.
+		if self._owns_transaction():
+			yield
+			return
+
+		async with self._write_lock:
+			try:
+				yield
+				await self.conn.commit()
+			except BaseException:
+				await self.conn.rollback()
+				raise
+
+	async def _write(self, query:str, params:tuple) -> bool:
+		queue = self._queue
+		if queue is None or self._owns_transaction():
+			async with self._writing():
+				await self.conn.execute(query, params)
+			return True
+
+		future = asyncio.get_running_loop().create_future()
+		queue.put_nowait((query, params, future))
+		return await future
+
+	async def start_writer(self, *, batch_size:int = 1000, flush_interval_ms:float = 10) -> None:
+		"""Starts a background writer that groups `insert`, `update` and `delete` calls into shared commits.
+
+		While it runs those calls are queued, and each one returns once the batch holding it is committed.
+		A batch is committed when it reaches `batch_size` statements or `flush_interval_ms` after its first one.
+
+		Parameters
+		----------
+		batch_size : int [Optional]
+			The maximum number of statements committed together. Defaults to 1000.
+		flush_interval_ms : float [Optional]
+			The longest time in milliseconds a statement waits for others to join its batch. Defaults to 10.
+		"""
+		if self._writer is not None:
+			return
+		self._queue = asyncio.Queue()
+		self._writer = asyncio.create_task(self._drain(self._queue, batch_size, flush_interval_ms / 1000))
+
+	async def stop_writer(self) -> None:
+		"""Commits the statements still queued and stops the background writer."""
+		if self._writer is None:
+			return
+		#Writes made from now on run directly instead of being queued behind the stop sentinel.
+		queue, writer = self._queue, self._writer
+		self._queue = None
+		self._writer = None
+		queue.put_nowait(None)
+		await writer
+
+		leftover = _take_queued(queue)
+		if leftover:
+			try:
+				await self._apply_batch(leftover)
+			except Exception as e:
+				_fail_writes(leftover, e)
+
+	async def _drain(self, queue:asyncio.Queue, batch_size:int, flush_interval:float) -> None:
+		loop = asyncio.get_running_loop()
+		stopping = False
+		while not stopping:
+			item = await queue.get()
+			if item is None:
+				break
+			batch = [item]
+			deadline = loop.time() + flush_interval
+			while len(batch) < batch_size:
+				timeout = deadline - loop.time()
+				if timeout <= 0:
+					break
+				try:
+					item = await asyncio.wait_for(queue.get(), timeout)
+				except asyncio.TimeoutError:
+					break
+				if item is None:
+					stopping = True
+					break
+				batch.append(item)
+			try:
+				await self._apply_batch(batch)
+			except Exception as e:
+				#The connection is unusable, so stop the writer and fail every queued write instead of leaving it waiting.
+				if self._queue is queue:
+					self._queue = None
+					self._writer = None
+				_fail_writes(batch + _take_queued(queue), e)
+				return
+
+	async def _apply_batch(self, batch:list) -> None:
+		async with self._write_lock:
+			#sqlite3 opens the transaction on the first statement, so the whole batch shares one commit.
+			pending = []
+			for query, params, future in batch:
+				try:
+					await self.conn.execute(query, params)
+				except Exception as e:
+					if not future.done():
+						future.set_exception(e)
+				else:
+					pending.append(future)
+			try:
+				await self.conn.commit()
+			except Exception as e:
+				for future in pending:
+					if not future.done():
+						future.set_exception(e)
+				await self.conn.rollback()
+			else:
+				for future in pending:
+					#A caller that was cancelled while waiting already has its future done.
+					if not future.done():
+						future.set_result(True)
 	
 	async def create_tables(self, table_list:list) -> None:
 		"""Creates a table in the database.
@@ -47,17 +272,15 @@ class SQLite:
 		"""
 
 		try:
-			for table in table_list:
-				for name, columns in table.items():
-					query = f"CREATE TABLE IF NOT EXISTS {name} ("
-					for column, datatype in columns.items():
-						query += f"{column} {datatype},"
-					query = query[:-1] + ")"
-					async with self.conn.cursor() as cur:
-						await cur.execute(query)
+			async with self._writing():
+				for table in table_list:
+					for name, columns in table.items():
+						columns = ",".join(f"{_qid(column)} {datatype}" for column, datatype in columns.items())
+						query = f"CREATE TABLE IF NOT EXISTS {_qid(name)} ({columns})"
+						await self.conn.execute(query)
 
 		except Exception as e:
-			raise DatabaseTableException(e)
+			raise DatabaseTableException(str(e)) from e
 		
 
 	async def drop_table(self, table:str) -> None:
@@ -70,12 +293,16 @@ class SQLite:
 		"""
 
 		try:
-			query = f"DROP TABLE IF EXISTS {table}"
-			async with self.conn.cursor() as cur:
-				await cur.execute(query)
+			query = f"DROP TABLE IF EXISTS {_qid(table)}"
+			async with self._writing():
+				await self.conn.execute(query)
+				#The full text index would go stale without the table's triggers, so it is dropped along with it.
+				if await self._indexed_columns(table):
+					await self.conn.execute(f"DROP TABLE IF EXISTS {_qid(f'{table}_fts')}")
+			self._fts_columns.pop(table, None)
 		
 		except Exception as e:
-			raise DatabaseTableException(e)
+			raise DatabaseTableException(str(e)) from e
 		
 
 	async def insert(self, table:str, **data) -> bool:
@@ -90,27 +317,77 @@ class SQLite:
 
 		Returns
 		-------
-		None
+		bool
+			Whether the data was inserted successfully or not.
+		"""
+
+		return await self.insert_positional(table, tuple(data), tuple(data.values()))
+
+	async def insert_positional(self, table:str, columns:tuple, values:tuple) -> bool:
+		"""Inserts a row whose values are already ordered like the given columns.
+
+		Parameters
+		----------
+		table : str
+			The name of the table to insert data into.
+		columns : tuple
+			The column names.
+		values : tuple
+			The values to insert, in the same order as `columns`.
+
+		Returns
+		-------
+		bool
 			Whether the data was inserted successfully or not.
 		"""
 
 		try:
-			query = f"INSERT INTO {table} ("
-			for column, value in data.items():
-				query += f"{column},"
-			query = query[:-1] + ") VALUES ("
-			#Question marks for the values
-			for i in range(len(data)):
-				query += "?,"
-			query = query[:-1] + ")"
-			async with self.conn.cursor() as cur:
-				await cur.execute(query, tuple(data.values()))
-				await self.conn.commit()
-				return True
+			query = _build_insert_sql(table, tuple(columns))
+			return await self._write(query, tuple(values))
+
+		except Exception as e:
+			raise DatabaseInsertionException(str(e)) from e
+
+	async def insert_many(self, table:str, columns:list, rows, *, batch_size:int = 10_000) -> bool:
+		"""Inserts multiple rows to a table in the database, committing once for the whole batch.
+
+		Either all the rows are inserted or, if one of them fails, none of them are.
+
+		Parameters
+		----------
+		table : str
+			The name of the table to insert data into.
+		columns : list
+			The column names, in the same order as the values in each row.
+		rows : iterable
+			An iterable of tuples, each holding the values of one row.
+		batch_size : int [Optional]
+			The number of rows passed to `executemany` at a time. Defaults to 10000.
+
+		Returns
+		-------
+		bool
+			Whether the data was inserted successfully or not.
+		"""
+
+		try:
+			query = _build_insert_sql(table, tuple(columns))
+			#A failure rolls back the rows before the failing one rather than leaving them for the next commit.
+			async with self._writing():
+				await self._insert_batches(query, rows, batch_size)
+			return True
 
 		except Exception as e:
-			raise DatabaseInsertionException(e)
+			raise DatabaseInsertionException(str(e)) from e
 		
+	async def _insert_batches(self, query:str, rows, batch_size:int) -> None:
+		rows = iter(rows)
+		while True:
+			batch = list(itertools.islice(rows, batch_size))
+			if not batch:
+				break
+			await self.conn.executemany(query, batch)
+
 	async def fetch(self, table:str, *, data_filter:dict = None, **sorting) -> list:
 		""" Fetches data from the database.
 		
@@ -131,28 +408,15 @@ class SQLite:
 		"""
 
 		try:
-			query = f"SELECT * FROM {table}"
+			filter_columns = tuple(data_filter) if data_filter else ()
+			query = _build_select_sql(table, filter_columns, sorting.get('sort_by'), sorting.get('sort'))
+
 			if data_filter:
-				query += " WHERE "
-				for column, value in data_filter.items():
-					query += f"{column} = ? AND "
-				query = query[:-5]
-
-			if sorting:
-				sort_by = sorting.get('sort_by', None)
-				sort = sorting.get('sort', None)
-				if sort_by and sort:
-					query += f" ORDER BY {sort_by} {sort}"
-
-			async with self.conn.cursor() as cur:
-				if data_filter:
-					await cur.execute(query, tuple(data_filter.values()))
-				else:
-					await cur.execute(query)
-				return await cur.fetchall()
+				return await self.conn.execute_fetchall(query, tuple(data_filter[column] for column in filter_columns))
+			return await self.conn.execute_fetchall(query)
 		
 		except Exception as e:
-			raise DatabaseFetchException(e)
+			raise DatabaseFetchException(str(e)) from e
 		
 	async def fetch_element(self, table:str, element:str, column:str) -> list:
 		"""Fetches a single element from the database in given column.
@@ -172,12 +436,87 @@ class SQLite:
 			A list of data in tuple format fetched from the database.
 		"""
 		try:
-			query = f"SELECT * FROM {table} WHERE {column} LIKE ?"
-			async with self.conn.cursor() as cur:
-				await cur.execute(query, (f'%{element}%',))
-				return await cur.fetchall()
+			#The trigram index only matches strings of at least 3 characters.
+			if len(element) >= 3 and column in await self._indexed_columns(table):
+				fts_table = _qid(f"{table}_fts")
+				query = (
+					f"SELECT t.* FROM {_qid(table)} t JOIN {fts_table} f ON f.rowid = t.rowid "
+					f"WHERE f.{_qid(column)} MATCH ?"
+				)
+				return await self.conn.execute_fetchall(query, ('"' + element.replace('"', '""') + '"',))
+
+			query = f"SELECT * FROM {_qid(table)} WHERE {_qid(column)} LIKE ?"
+			return await self.conn.execute_fetchall(query, (f'%{element}%',))
 		except Exception as e:
-			raise DatabaseFetchException(e)
+			raise DatabaseFetchException(str(e)) from e
+
+	async def _indexed_columns(self, table:str) -> tuple:
+		try:
+			return self._fts_columns[table]
+		except KeyError:
+			schema, _, name = table.rpartition(".")
+			pragma = f"{_qid(schema)}.table_info" if schema else "table_info"
+			rows = await self.conn.execute_fetchall(f"PRAGMA {pragma}({_qid(f'{name}_fts')})")
+			columns = self._fts_columns[table] = tuple(row[1] for row in rows)
+			return columns
+
+	async def create_fts_index(self, table:str, column:str) -> None:
+		"""Creates a full text index on a column, which `fetch_element` then uses instead of scanning the table.
+
+		The index is stored in the `{table}_fts` FTS5 table using the trigram tokenizer, so it matches
+		substrings like the `LIKE` search it replaces. Triggers keep it in sync with the table. Indexing
+		another column of the same table rebuilds the index over all the indexed columns.
+
+		Unlike the `LIKE` search, which `fetch_element` still uses for search strings shorter than
+		3 characters, the index matches `%` and `_` literally instead of as wildcards.
+
+		Parameters
+		----------
+		table : str
+			The name of the table to index.
+		column : str
+			The column to index.
+		"""
+
+		try:
+			self._fts_columns.pop(table, None)
+			indexed = await self._indexed_columns(table)
+			if column in indexed:
+				return
+
+			fts_table = f"{table}_fts"
+			#SQLite only accepts a schema on the created objects, the trigger's table and body use bare names.
+			content = table.rpartition(".")[2]
+			name, fts = _qid(content), _qid(f"{content}_fts")
+			qualified_fts = _qid(fts_table)
+			triggers = [_qid(fts_table + suffix) for suffix in ("_ai", "_ad", "_au")]
+			columns = [_qid(col) for col in indexed + (column,)]
+			cols = ", ".join(columns)
+			new_values = ", ".join(f"new.{col}" for col in columns)
+			old_values = ", ".join(f"old.{col}" for col in columns)
+			#The FTS5 columns can't be altered, so an existing index is replaced by one over all the columns.
+			statements = [f"DROP TRIGGER IF EXISTS {trigger}" for trigger in triggers] + [
+				f"DROP TABLE IF EXISTS {qualified_fts}",
+				f"CREATE VIRTUAL TABLE {qualified_fts} USING fts5({cols}, content='{content}', content_rowid='rowid', tokenize='trigram')",
+				f"CREATE TRIGGER {triggers[0]} AFTER INSERT ON {name} BEGIN "
+				f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.rowid, {new_values}); END",
+				f"CREATE TRIGGER {triggers[1]} AFTER DELETE ON {name} BEGIN "
+				f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.rowid, {old_values}); END",
+				f"CREATE TRIGGER {triggers[2]} AFTER UPDATE ON {name} BEGIN "
+				f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.rowid, {old_values}); "
+				f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.rowid, {new_values}); END",
+				#Index the rows which already exist in the table.
+				f"INSERT INTO {qualified_fts}({fts}) VALUES ('rebuild')",
+			]
+			try:
+				async with self._writing():
+					for query in statements:
+						await self.conn.execute(query)
+			finally:
+				self._fts_columns.pop(table, None)
+
+		except Exception as e:
+			raise DatabaseTableException(str(e)) from e
 		
 	async def update(self, table:str, data_filter:dict = None, **data) -> bool:
 		"""Updates data in the database.
@@ -198,21 +537,13 @@ class SQLite:
 		"""
 
 		try:
-			query = f"UPDATE {table} SET "
-			for column, value in data.items():
-				query += f"{column} = ?,"
-			query = query[:-1]
-			query += " WHERE "
-			for column, value in data_filter.items():
-				query += f"{column} = ? AND "
-			query = query[:-5]
-			async with self.conn.cursor() as cur:
-				await cur.execute(query, tuple(data.values()) + tuple(data_filter.values()))
-				await self.conn.commit()
-				return True
+			columns = tuple(data)
+			filter_columns = tuple(data_filter)
+			query = _build_update_sql(table, columns, filter_columns)
+			return await self._write(query, tuple(data[column] for column in columns) + tuple(data_filter[column] for column in filter_columns))
 		
 		except Exception as e:
-			raise DatabaseUpdateException(e)
+			raise DatabaseUpdateException(str(e)) from e
 		
 	async def delete(self, table:str, **data_filter) -> bool:
 		"""Deletes data from the database.
@@ -231,20 +562,16 @@ class SQLite:
 		"""
 
 		try:
-			query = f"DELETE FROM {table} WHERE "
-			for column, value in data_filter.items():
-				query += f"{column} = ? AND "
-			query = query[:-5]
-			async with self.conn.cursor() as cur:
-				await cur.execute(query, tuple(data_filter.values()))
-				await self.conn.commit()
-				return True
+			filter_columns = tuple(data_filter)
+			query = _build_delete_sql(table, filter_columns)
+			return await self._write(query, tuple(data_filter[column] for column in filter_columns))
 		
 		except Exception as e:
-			raise DatabaseDeleteException(e)
+			raise DatabaseDeleteException(str(e)) from e
 		
 
 	async def close(self):
 		"""Close the connection"""
+		await self.stop_writer()
 		if self.conn:
 			await self.conn.close()
\ No newline at end of file
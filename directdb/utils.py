@@ -0,0 +1,57 @@
+# LICENSE
+# -----------------------------------------------------------------------
+# Copyright (c) CannonBall Chris,  2024
+# directdb is distributed under the terms of the GNU Affero General Public License (AGPL).
+# You can find a copy of the license in the LICENSE file included with this distribution.
+# The AGPL is a copyleft license that ensures the freedom to use, modify, and distribute the library's code, even in the case of web-based services.
+# By using directdb, you agree to comply with the terms and conditions of the AGPL.
+
+import functools
+import re
+
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_SORT_ORDERS = ('ASC', 'DESC')
+
+@functools.lru_cache(maxsize=None)
+def quote_identifier(name:str, fold_case:bool = False) -> str:
+	"""Validates and quotes a table or column name so it can be safely placed in a query.
+
+	The result is cached, so each distinct identifier is only checked and quoted once.
+
+	Parameters
+	----------
+	name : str
+		The identifier, optionally schema qualified like `schema.table`.
+	fold_case : bool [Optional]
+		Whether to lowercase the identifier, matching how PostgreSQL treats unquoted names. Defaults to False.
+
+	Returns
+	-------
+	str
+		The quoted identifier.
+	"""
+	parts = name.split('.')
+	for part in parts:
+		if not _IDENTIFIER_RE.fullmatch(part):
+			raise ValueError(f"Invalid identifier: {name!r}")
+	if fold_case:
+		parts = [part.lower() for part in parts]
+	return '.'.join(f'"{part}"' for part in parts)
+
+def sort_order(sort:str) -> str:
+	"""Validates the sort order of a query.
+
+	Parameters
+	----------
+	sort : str
+		The order to sort by. Can be either 'ASC' or 'DESC'.
+
+	Returns
+	-------
+	str
+		The uppercased sort order.
+	"""
+	order = sort.upper()
+	if order not in _SORT_ORDERS:
+		raise ValueError(f"Invalid sort order: {sort!r}")
+	return order